@@ -42,13 +42,37 @@
 
 from __future__ import print_function
 
-import os, sys, shutil, pdb
-import argparse
-from subprocess import Popen, PIPE
-from glob import glob
+import os, re, sys, shutil
+import socket, struct
 
 version = '0.1'
 
+CONFIG_DIR = '/etc/sysconfig/network-scripts'
+SYSTEMCTL = '/usr/bin/systemctl'
+
+# KEY=value or KEY="value", one per line, optionally followed by a # comment
+IFCFG_LINE = re.compile(r'^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(?:"([^"\n]*)"|([^"\n]*?))[ \t]*(?:[ \t]#.*)?$', re.M)
+HWADDR_NOISE = re.compile(r'[^0-9A-F]')
+
+# rtnetlink(7) - just enough of it to list and rename links
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_LOWER_UP = 0x10000
+
+NLMSGHDR = '=LHHLL'
+IFINFOMSG = '=BxHiII'
+RTATTR = '=HH'
+
 INSTALL = """
 [Unit]
 Description=Persistently name interfaces to the ethN naming convention
@@ -63,11 +87,9 @@ WantedBy=network.target
 ;Alias=ethN.service
 """
 
-parser = argparse.ArgumentParser(description='Allows network interfaces to be renamed based on the desired configuration in the ifcfg files.')
-parser.add_argument('-i', '--install', action='store_true', help='Installs the script as a systemd unit that will execute prior to the network.target.')
-args = parser.parse_args()
-
 def install():
+    from subprocess import call          # Only needed here, keep it off the boot path
+
     unit_install_path = '/etc/systemd/system/systemd_persistent_eth.service'
     script_install_path = '/usr/sbin/systemd_persistent_eth.py'
 
@@ -75,7 +97,7 @@ def install():
     
     try:
         shutil.copy(__file__, script_install_path)
-    except:
+    except (IOError, OSError):
         print('Failed to copy %s to %s' %(__file__, script_install_path)) 
         return True
 
@@ -84,16 +106,15 @@ def install():
     
     try:
         f = open(unit_install_path, 'w')
-    except:
+    except (IOError, OSError):
         print('Failed to open %s - Is the script running as root?' %(unit_install_path)) 
         return True
 
     try:
-        f.write(INSTALL)
-        f.close()
-    except:
+        with f:
+            f.write(INSTALL)
+    except (IOError, OSError):
         print('Failed to write to %s - No space left?' %(unit_install_path))
-        f.close()
         return True
 
     print('Wrote the following to %s' %(unit_install_path))
@@ -102,153 +123,280 @@ def install():
     print('%s' %('-' * 50))
 
 
-    print('Issuing a "daemon-reload" to systemd')
-    systemctl_proc = Popen(['systemctl', 'daemon-reload'])
-
-    systemctl_proc.wait()
-    if systemctl_proc.returncode:
-        print('Failed to issue "systemctl daemon-reload" - Will requires manual intervention - Exiting.')
-        return True
-
-    del systemctl_proc
-
-
+    # enable reloads the daemon configuration itself unless given --no-reload,
+    # so a separate daemon-reload call is not needed
     print('Issuing a "enable systemd_persistent_eth" to systemd')
-    systemctl_proc = Popen(['systemctl', 'enable', 'systemd_persistent_eth'])
+    # stderr is left alone so systemctl's own complaints still reach the user.
+    # An absolute path and close_fds=False (nothing else is open at this point)
+    # let Python 3.8+ start the child with posix_spawn rather than fork+exec.
+    with open(os.devnull, 'r+b') as devnull:
+        returncode = call([SYSTEMCTL, 'enable', 'systemd_persistent_eth'], stdin=devnull, stdout=devnull, close_fds=False)
 
-    systemctl_proc.wait()
-    if systemctl_proc.returncode:
+    if returncode:
         print('Failed to issue "systemctl enable systemd_persistent_eth" - Will requires manual intervention - Exiting.')
         return True
     
     return None
 
-def get_interface_dict():
+def netlink_socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.bind((0, 0))
+
+    return sock
+
+def netlink_recv(sock):
+    while True:
+        data = sock.recv(65536)
+        offset = 0
+
+        while offset < len(data):
+            length, msg_type, flags, seq, pid = struct.unpack_from(NLMSGHDR, data, offset)
+            yield msg_type, seq, data[offset + 16:offset + length]
+            offset += (length + 3) & ~3
+
+def netlink_attrs(payload, offset):
+    while offset + 4 <= len(payload):
+        attr_len, attr_type = struct.unpack_from(RTATTR, payload, offset)
+        if attr_len < 4:
+            return
+        yield attr_type, offset + 4, offset + attr_len
+        offset += (attr_len + 3) & ~3
+
+def netlink_link_msg(index, flags=0, change=0, name=None):
+    payload = struct.pack(IFINFOMSG, socket.AF_UNSPEC, 0, index, flags, change)
+
+    if name:
+        attr = name.encode() + b'\0'
+        payload += struct.pack(RTATTR, 4 + len(attr), IFLA_IFNAME) + attr
+        payload += b'\0' * (-len(payload) % 4)
+
+    return payload
+
+def get_interface_dict(quiet=False):
     interfaces = {}
 
-    ip_output = Popen(['ip', 'link', 'show'], stdout=PIPE)
-    ip_output.wait()
+    sock = netlink_socket()
+    sock.send(struct.pack(NLMSGHDR, 32, RTM_GETLINK, NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + netlink_link_msg(0))
+
+    for msg_type, seq, payload in netlink_recv(sock):
+        if msg_type in (NLMSG_DONE, NLMSG_ERROR):
+            break
+
+        if msg_type != RTM_NEWLINK:
+            continue
 
-    for idx,line in enumerate(ip_output.stdout):
-        if idx > 1:            # Omits loopback entries
-            split_line = [ entry.rstrip(':') for entry in line.split()]
-            if not idx % 2:    # Will be lines that have a device identifier
-                interface = split_line[1].strip()
-                connection = None if 'LOWER_UP' not in line else True
-            else:
-                hwaddr = split_line[1].upper().strip()
-                print("%15s: %s%s" %(interface, hwaddr, '' if not connection else ' - UP'))
-                interfaces[interface] = hwaddr,connection,interface
+        family, link_type, index, flags, change = struct.unpack_from(IFINFOMSG, payload)
+        if flags & IFF_LOOPBACK:
+            continue
+
+        # Only the name and address are copied out - the stats blobs that make
+        # up most of each message are stepped over
+        attrs = {}
+        for attr_type, start, end in netlink_attrs(payload, 16):
+            if attr_type in (IFLA_ADDRESS, IFLA_IFNAME):
+                attrs[attr_type] = payload[start:end]
+                if len(attrs) == 2:
+                    break
+
+        if IFLA_ADDRESS not in attrs:
+            continue            # No link-layer address, nothing to match a HWADDR against
+
+        interface = attrs[IFLA_IFNAME].rstrip(b'\0').decode()
+        hwaddr = ':'.join(['%02X' %(byte) for byte in bytearray(attrs[IFLA_ADDRESS])])
+        connection = None if not flags & IFF_LOWER_UP else True
+        if not quiet:
+            print("%15s: %s%s" %(interface, hwaddr, '' if not connection else ' - UP'))
+        interfaces[index] = [hwaddr, connection, interface, bool(flags & IFF_UP)]
+
+    sock.close()
 
     return interfaces
 
-def link_name_change(idx, entry, dest=None):
-    ip_proc = Popen(['ip', 'link', 'set', 'dev', entry, 'down'])
-    ip_proc.wait()
+def link_down(cmds, index, name):
+    cmds.append((index, name, netlink_link_msg(index, 0, IFF_UP)))
 
-    del ip_proc
+def link_up(cmds, index, name):
+    cmds.append((index, name, netlink_link_msg(index, IFF_UP, IFF_UP)))
 
-    if not dest:
-        ip_proc = Popen(['ip', 'link', 'set', 'dev', entry, 'name', 'temp%d' %(idx)])
-    else:
-        ip_proc = Popen(['ip', 'link', 'set', 'dev', entry, 'name', dest])
-    ip_proc.wait()
+def link_name_change(cmds, index, dest):
+    # The link has to be down already - see main()
+    cmds.append((index, dest, netlink_link_msg(index, name=dest)))
 
-    del ip_proc
+    return dest
 
-    ip_proc = Popen(['ip', 'link', 'set', 'dev', 'temp%d' %(idx), "up"])
-    ip_proc.wait()
+def run_batch(cmds):
+    # Returns the (index, name) of every change the kernel refused, or None if
+    # its replies couldn't be read and the outcome is unknown
+    if not cmds:
+        return []
 
-    del ip_proc
+    # The kernel works through every message in the datagram, and answers any
+    # that fail with an NLMSG_ERROR whether or not an ack was asked for. Only
+    # the last one asks, so a large batch can't overflow the receive buffer
+    # with acks before they are read - its ack marks the end of the replies.
+    last = len(cmds)
+    sock = netlink_socket()
+    sock.send(b''.join([struct.pack(NLMSGHDR, 16 + len(msg), RTM_NEWLINK,
+                                    NLM_F_REQUEST | (NLM_F_ACK if seq == last else 0), seq, 0) + msg
+                        for seq, (index, name, msg) in enumerate(cmds, 1)]))
 
-def get_config_files():
-    files = {}
+    failed = []
+    try:
+        for msg_type, seq, payload in netlink_recv(sock):
+            if msg_type != NLMSG_ERROR:
+                continue
+
+            error = struct.unpack_from('=i', payload)[0]
+            if error:
+                index, name, msg = cmds[seq - 1]
+                print('Failed to set %s: %s' %(name, os.strerror(-error)))
+                failed.append((index, name))
+
+            if seq == last:
+                break
+    except (socket.error, OSError) as e:
+        print('Failed to read the kernel\'s replies, some link changes may not be reported: %s' %(e))
+        failed = None
+
+    sock.close()
+
+    del cmds[:]
+
+    return failed
+
+def iter_configs():
+    try:
+        filelist = os.listdir(CONFIG_DIR)
+    except OSError:
+        return
 
-    filelist = glob('/etc/sysconfig/network-scripts/ifcfg-eth*')
-    
     for entry in filelist:
-        if ':' in entry:
-            continue            #VLAN file, disregard
+        if not entry.startswith('ifcfg-eth') or ':' in entry:
+            continue            #Not an ethN file, or a VLAN file, disregard
 
-        f = open(entry, 'r')
-        files[entry] = f.read()
-        f.close()
+        path = os.path.join(CONFIG_DIR, entry)
+        with open(path, 'r') as f:
+            data = f.read()
 
-    return files
+        if 'HWADDR' not in data:
+            continue            #Nothing to match an interface against, skip the parse
 
-def parse_config(string_input):
-    config_dict = {}
+        # Keys are kept as written - initscripts reads these as case-sensitive
+        # shell variables, which the 'HWADDR' check above already assumes
+        yield path, dict([(match.group(1), (match.group(2) or match.group(3) or '').strip())
+                          for match in IFCFG_LINE.finditer(data)])
 
-    for line in string_input.split('\n'):
-        split_line = line.split('=')
-        if len(split_line) > 1:
-            config_dict[split_line[0].upper().strip()] = split_line[1].upper().strip()
+def normalize_hwaddr(hwaddr):
+    # Same form get_interface_dict() produces - upper case, colon separated.
+    # Anything that doesn't come down to exactly six octets is not a MAC.
+    digits = HWADDR_NOISE.sub('', hwaddr.upper())
+    if len(digits) != 12:
+        return None
 
-    return config_dict
+    return ':'.join([digits[idx:idx + 2] for idx in range(0, len(digits), 2)])
 
-def get_config():
-    parsed_entries = {}
+def get_hwaddr_index(configs):
+    hw_index = {}
 
-    cached_configs = get_config_files()
-    
-    for entry in cached_configs.keys():
-        parsed_entries[entry] = parse_config(cached_configs[entry])
+    for path, config in configs:
+        name = config.get('DEVICE') or config.get('NAME')
+        if 'HWADDR' not in config or not name:
+            continue
+
+        # Normalised here, once per file - assign_interface() only looks it up
+        hwaddr = normalize_hwaddr(config['HWADDR'])
+        if not hwaddr:
+            print('Skipping %s - HWADDR %s is not a MAC address' %(path, config['HWADDR']))
+            continue
+
+        hw_index[hwaddr] = name.lower()
 
-    return parsed_entries
+    return hw_index
 
-def assign_interface(interface, configs):
-    named = 0
+def assign_interface(index, interface, hw_index, cmds):
+    target = hw_index.get(interface[0])
+    if not target:
+        return 0
 
-    for entry in configs.keys():
-        if configs[entry]['HWADDR'].strip('"') in interface[0]:
-            if 'DEVICE' in configs[entry].keys():
-                link_name_change(0, interface[2], configs[entry]['DEVICE'].lower().strip('"'))
-                named += 1
-            elif 'NAME' in configs[entry].keys():
-                link_name_change(0, interface[2], configs[entry]['NAME'].lower().strip('"'))
-                named += 1
+    interface[2] = link_name_change(cmds, index, target)
 
-    return named
+    return 1
 
 def main():
     print('Gathering previous name association')
 
-    interfaces = get_interface_dict()
-    for idx, entry in enumerate(interfaces.keys()):
-        link_name_change(idx, entry)
+    cmds = []
 
-    print('Renamed all interfaces to temporary device names.')
+    # Keyed by ifindex, which survives renames - names are tracked in place
     interfaces = get_interface_dict()
 
-    print('Loading configuration files in /etc/sysconfig/network-scripts/')
-    configs = get_config()
+    print('Loading configuration files in %s/' %(CONFIG_DIR))
+    hw_index = get_hwaddr_index(iter_configs())
 
-    print('Applying names from HWADDR flags in configuration files')
-    for interface_entry in interfaces.keys():
-        success = assign_interface(interfaces[interface_entry], configs)
+    # The kernel refuses to rename a link that is up, so each one that is gets
+    # taken down once, renamed as many times as needed, and brought back up at
+    # the end. Links that were down before the run are left down.
+    for index in interfaces:
+        if interfaces[index][3]:
+            link_down(cmds, index, interfaces[index][2])
+
+    # The temporary and configured names don't depend on the kernel's answers,
+    # so both go out as one batch. The fallback pass has to know which of those
+    # renames actually took, so it gets a batch of its own.
+    print('Renaming all interfaces to temporary device names.')
+    for idx, index in enumerate(interfaces):
+        interfaces[index][2] = link_name_change(cmds, index, 'temp%d' %(idx))
 
-    unnamed = len(interfaces.keys()) - success
+    print('Applying names from HWADDR flags in configuration files')
+    assigned = [interface_entry for interface_entry in interfaces
+                if assign_interface(interface_entry, interfaces[interface_entry], hw_index, cmds)]
+
+    failed = run_batch(cmds)
+    if failed is None or failed:
+        print('%s link changes failed, re-reading the current names' %('Some' if failed is None else len(failed)))
+        current = get_interface_dict(quiet=True)
+        for index in interfaces:
+            if index in current:
+                interfaces[index][2] = current[index][2]
+
+    named = set([index for index in assigned if interfaces[index][2] == hw_index[interfaces[index][0]]])
+    success = len(named)
+    unnamed = len(interfaces) - success
     print('%d Assigned, %d Unnamed:' %(success, unnamed))
-    interfaces = get_interface_dict()
 
     if unnamed:
         print('Renaming the devices not found in the ifcfg-ethN files to an arbitrary ethN designation')
         idx = 0
-        for interface_entry in interfaces.keys():
-            if 'eth' not in interfaces[interface_entry][2]:
-                tempname = 'eth%d' %(idx)
-                while tempname in interfaces.keys():
+        taken = set([entry[2] for entry in interfaces.values()])
+        for interface_entry in interfaces:
+            if interface_entry not in named:
+                while 'eth%d' %(idx) in taken:
                     idx += 1
-                    tempname = 'eth%d' %(idx)
+                tempname = 'eth%d' %(idx)
+                taken.add(tempname)
 
-                link_name_change(0, interface_entry, tempname)
+                interfaces[interface_entry][2] = link_name_change(cmds, interface_entry, tempname)
                 idx += 1
 
+    for index in interfaces:
+        if interfaces[index][3]:
+            link_up(cmds, index, interfaces[index][2])
+
+    failed = run_batch(cmds)
+    if failed is None or failed:
+        print('%s link changes failed' %('Some' if failed is None else len(failed)))
+
     print('Final naming scheme')
     temp = get_interface_dict()
     
 
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Allows network interfaces to be renamed based on the desired configuration in the ifcfg files.')
+    parser.add_argument('-i', '--install', action='store_true', help='Installs the script as a systemd unit that will execute prior to the network.target.')
+    args = parser.parse_args()
+
     print('version: %s' % version)
 
     ret = None